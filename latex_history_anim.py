@@ -7,59 +7,106 @@ Usage:
 
 What it does:
     - Finds all git commits that touched the specified .tex file
-    - For each commit (oldest -> newest):
-        - checks out the commit (detached HEAD)
-        - builds the specified .tex into a PDF (tries latexmk, falls back to pdflatex)
-        - uses pdftoppm to render up to `--max-pages` PNG pages
-        - composes the PNG pages side-by-side into a single image (up to max-pages)
-        - writes a composed PNG per commit
-    - After all commits, composes a GIF (or AVI if you prefer) from the composed PNGs.
-
-Note: The script leaves the repository checked out to the original branch at the end (attempts to).
+    - For each commit (oldest -> newest), in parallel worker processes:
+        - exports the commit's tree into its own temporary directory (git archive)
+        - builds the specified .tex into a PDF (tries tectonic, then latexmk, falls back to pdflatex)
+        - renders up to `--max-pages` pages (in-process with pypdfium2, or JPEGs via pdftoppm)
+        - PDFs and pdftoppm pages are cached in `<out-dir>/.pdf_cache`, keyed by the .tex path and the git tree
+          of its directory (files outside that directory are not part of the key)
+        - composes the pages side-by-side into a single image (up to max-pages)
+        - writes a composed PNG per commit (only with --keep-temp, when ffmpeg is missing, or for gifski)
+    - Composes a GIF (or MP4/WebM) from the frames: GIFs are encoded by gifski from the PNGs if it is
+      installed; otherwise frames are streamed into ffmpeg if available, or GIFs are written with one
+      global palette by Pillow (other formats via imageio).
+
+Note: The checkout of the repository itself is never modified; every commit is built from a `git archive` export.
+Note: Builds are cached (and commits with the same sources built once) by the contents of the .tex file's
+      directory only, so changes to files outside it (e.g. \\input{../common.tex}) are not detected; use a
+      fresh --out-dir for such documents.
 """
 
 import argparse
+import hashlib
+import math
 import os
+import re
 import subprocess
 import sys
+import tarfile
 import tempfile
 import shutil
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fractions import Fraction
 from pathlib import Path
-from PIL import Image
+from PIL import GifImagePlugin, Image
 import imageio
+import numpy as np
 import logging
 
+try:
+    # optional SIMD Lanczos resampler; Pillow's Image.resize is used when missing
+    from pic_scale import Plan, Resampling
+except ImportError:
+    Plan = None
+
+try:
+    # optional in-process PDF renderer; pdftoppm is used when missing
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+# height (pixels) that rendered pages are scaled down to in the composed frames
+MAX_PAGE_HEIGHT = 1200
+
+# gap (pixels) between the pages of a composed frame
+PAGE_GAP = 8
+
+# outputs that imageio writes through its ffmpeg plugin (imageio-ffmpeg) when ffmpeg is not in PATH
+VIDEO_SUFFIXES = (".mp4", ".webm", ".mkv", ".mov", ".avi")
+
 
-def run(cmd, cwd=None, check=True, capture_output=False):
+def run(cmd, cwd=None, check=True, capture_output=False, input=None):
     logging.debug("RUN: %s (cwd=%s)", " ".join(cmd), cwd)
     return subprocess.run(cmd, cwd=cwd, check=check, stdout=(subprocess.PIPE if capture_output else None),
-                          stderr=(subprocess.PIPE if capture_output else None), text=True)
+                          stderr=(subprocess.PIPE if capture_output else None), text=True, input=input)
 
 
-def ensure_tools_exist():
-    missing = []
-    for tool in ("git", "pdftoppm"):
-        if shutil.which(tool) is None:
-            missing.append(tool)
+# external programs looked up once at startup; all but git (and pdftoppm without pypdfium2) are optional
+TOOLS = ("git", "tectonic", "latexmk", "pdflatex", "pdftoppm", "pdfinfo", "ffmpeg", "gifski")
+
+
+def find_tools():
+    """
+    Resolve every external program once, so PATH is not searched again for every commit.
+    Returns a dict tool name -> absolute path (None if not installed).
+    """
+    return {tool: shutil.which(tool) for tool in TOOLS}
+
+
+def ensure_tools_exist(tools):
+    required = ("git",) if pdfium is not None else ("git", "pdftoppm")
+    missing = [tool for tool in required if tools.get(tool) is None]
     if missing:
         raise RuntimeError(f"Missing required tools in PATH: {', '.join(missing)}. Install them and retry.")
 
 
-def get_commits_touching_file(repo_path, tex_file):
-    # returns commit hashes (oldest -> newest)
-    cmd = ["git", "-C", str(repo_path), "log", "--pretty=format:%H", "--reverse", "--", str(tex_file)]
+def get_commits_touching_file(git, repo_path, tex_file):
+    # returns commit hashes (oldest -> newest); git is the path to the executable
+    cmd = [git, "-C", str(repo_path), "log", "--pretty=format:%H", "--reverse", "--", str(tex_file)]
     proc = run(cmd, capture_output=True)
     hashes = [h.strip() for h in proc.stdout.splitlines() if h.strip()]
     logging.info("Found %d commits touching %s", len(hashes), tex_file)
     return hashes
 
 
-def build_latex(repo_path, tex_path, workdir, build_outdir):
+def build_latex(repo_path, tex_path, workdir, build_outdir, tools):
     """
-    Try latexmk first. If it fails or missing, fall back to pdflatex (2 runs).
+    Try tectonic first, then latexmk. If both fail or are missing, fall back to pdflatex (2 runs).
     tex_path must be a Path relative to repo_path (or absolute).
+    tools is the dict returned by find_tools().
     The PDF should appear in build_outdir (if pdflatex used, use -output-directory).
     Returns path to the resulting PDF or raises RuntimeError on failure.
     """
@@ -68,8 +115,24 @@ def build_latex(repo_path, tex_path, workdir, build_outdir):
     pdf_name = tex_path.with_suffix(".pdf").name
     build_outdir = Path(build_outdir)
 
+    # Try tectonic: single invocation (reruns as needed) and a persistent package cache in ~/.cache/Tectonic
+    tectonic_exe = tools.get("tectonic")
+    if tectonic_exe:
+        build_outdir.mkdir(parents=True, exist_ok=True)
+        cmd = [tectonic_exe, "-X", "compile", "--outdir", str(build_outdir), "--keep-intermediates", str(tex_path)]
+        try:
+            logging.info("Building with tectonic")
+            run(cmd, cwd=workdir)
+            produced_pdf = build_outdir / pdf_name
+            if produced_pdf.exists():
+                return produced_pdf
+            # else fallback
+            logging.warning("tectonic finished but PDF not found at %s", produced_pdf)
+        except subprocess.CalledProcessError as e:
+            logging.warning("tectonic failed: %s", getattr(e, "stderr", str(e)))
+
     # Try latexmk
-    latexmk_exe = shutil.which("latexmk")
+    latexmk_exe = tools.get("latexmk")
     if latexmk_exe:
         cmd = [latexmk_exe, "-pdf", "-interaction=nonstopmode", "-halt-on-error", "-silent",
                "-jobname=" + tex_path.stem, str(tex_path)]
@@ -88,9 +151,12 @@ def build_latex(repo_path, tex_path, workdir, build_outdir):
             logging.warning("latexmk failed: %s", getattr(e, "stderr", str(e)))
 
     # Fallback to pdflatex (2 passes)
-    pdflatex_exe = shutil.which("pdflatex")
+    pdflatex_exe = tools.get("pdflatex")
     if pdflatex_exe is None:
-        raise RuntimeError("Neither latexmk nor pdflatex is available to build the document.")
+        tried = [tool for tool in ("tectonic", "latexmk") if tools.get(tool)]
+        if tried:
+            raise RuntimeError(f"{' and '.join(tried)} did not produce a PDF, and pdflatex is not available.")
+        raise RuntimeError("None of tectonic, latexmk or pdflatex is available to build the document.")
 
     logging.info("Building with pdflatex (fallback)")
     # Ensure output directory exists and run pdflatex there with -output-directory
@@ -111,27 +177,170 @@ def build_latex(repo_path, tex_path, workdir, build_outdir):
     return produced_pdf
 
 
-def pdf_to_png_pages(pdf_path, out_prefix, dpi=150, max_pages=10):
+def fit_dpi(page_height_pt, dpi, max_height=None):
+    """
+    Returns the DPI (at most `dpi`) at which a page of page_height_pt points is no taller than
+    max_height pixels, so pages are not rasterized at a resolution that is downscaled afterwards anyway.
+    """
+    if not max_height or not page_height_pt:
+        return dpi
+    return max(1, min(dpi, int(max_height * 72 / page_height_pt)))
+
+
+def pdfinfo_page_height(pdf_path, pdfinfo):
+    """
+    Returns the height in points of the first page of the PDF (as displayed, i.e. honoring
+    its rotation) using Poppler's pdfinfo (path to the executable, may be None), or None if it
+    can not be determined.
+    """
+    if pdfinfo is None:
+        return None
+    try:
+        out = run([pdfinfo, str(pdf_path)], capture_output=True).stdout
+    except subprocess.CalledProcessError as e:
+        logging.debug("pdfinfo failed: %s", e)
+        return None
+    size = re.search(r"^Page size:\s+([\d.]+) x ([\d.]+) pts", out, re.MULTILINE)
+    if not size:
+        return None
+    width, height = float(size.group(1)), float(size.group(2))
+    rot = re.search(r"^Page rot:\s+(\d+)", out, re.MULTILINE)
+    if rot and int(rot.group(1)) % 180 == 90:
+        return width
+    return height
+
+
+def pdf_to_png_pages(pdf_path, out_prefix, tools, dpi=150, max_pages=10, max_height=None):
     """
-    Uses pdftoppm to create PNG pages.
-    Returns list of created png paths (ordered page1..pagen), capped at max_pages.
+    Uses pdftoppm to create JPEG pages (faster to decode than PNG), rendering only the first max_pages.
+    If max_height is given, the DPI is lowered so the first page is at most max_height pixels tall.
+    tools is the dict returned by find_tools().
+    Returns list of created image paths (ordered page1..pagen).
     """
-    pdftoppm = shutil.which("pdftoppm")
+    pdftoppm = tools.get("pdftoppm")
     if pdftoppm is None:
         raise RuntimeError("pdftoppm not found (required). Install Poppler utilities.")
 
-    # pdftoppm -png -r DPI input.pdf outprefix
-    cmd = [pdftoppm, "-png", "-r", str(dpi), str(pdf_path), str(out_prefix)]
+    if max_height:
+        dpi = fit_dpi(pdfinfo_page_height(pdf_path, tools.get("pdfinfo")), dpi, max_height)
+    out_prefix = Path(out_prefix)
+    cmd = [pdftoppm, "-jpeg", "-jpegopt", "quality=85", "-f", "1", "-l", str(max_pages),
+           "-r", str(dpi), str(pdf_path), str(out_prefix)]
     run(cmd)
-    # produced files like outprefix-1.png outprefix-2.png ...
-    produced = []
-    for i in range(1, max_pages + 1):
-        p = Path(f"{out_prefix}-{i}.png")
-        if p.exists():
-            produced.append(p)
-        else:
-            break
-    return produced
+    # produced files like outprefix-1.jpg outprefix-2.jpg ... (zero-padded to the page count's width)
+    return sorted(out_prefix.parent.glob(f"{out_prefix.name}-*.jpg"))
+
+
+def resize_lanczos(im, size, plans=None):
+    """
+    Lanczos-resize a PIL.Image to `size`, using pic-scale when it is installed.
+    - plans: optional dict used to reuse pic-scale Plans (precomputed filter weights) across
+      images sharing the same source size, target size and mode.
+    """
+    if Plan is None:
+        return im.resize(size, Image.LANCZOS)
+    key = (im.size, size, im.mode)
+    plan = plans.get(key) if plans is not None else None
+    if plan is None:
+        plan = Plan(im.size, size, Resampling.LANCZOS, im.mode)
+        if plans is not None:
+            plans[key] = plan
+    return plan.resize(im)
+
+
+def render_pdf_pages(pdf_path, dpi=150, max_pages=10, max_height=None):
+    """
+    Renders up to max_pages pages of the PDF in-process with pypdfium2.
+    If max_height is given, the DPI is lowered so the first page is at most max_height pixels tall.
+    Pages are rendered one after the other: pdfium is not thread-safe, and a page takes a few
+    milliseconds, less than starting processes and pickling the bitmaps back would cost; the
+    commit-level process pool keeps the cores busy instead.
+    Returns a list of PIL.Image (ordered page1..pagen); nothing is written to disk.
+    """
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        npages = min(len(pdf), max_pages)
+        if max_height and npages:
+            dpi = fit_dpi(pdf[0].get_height(), dpi, max_height)
+        return [pdf[i].render(scale=dpi / 72).to_pil() for i in range(npages)]
+    finally:
+        pdf.close()
+
+
+def pdf_page_sizes(pdf_path, dpi=150, max_pages=10, max_height=None):
+    """
+    Returns the (width, height) in pixels of the pages render_pdf_pages() renders with the same
+    arguments, computed from the page boxes without rasterizing anything.
+    """
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        npages = min(len(pdf), max_pages)
+        if max_height and npages:
+            dpi = fit_dpi(pdf[0].get_height(), dpi, max_height)
+        # pypdfium2 sizes the bitmap of a page as ceil(page size in points * scale)
+        return [(math.ceil(pdf[i].get_width() * dpi / 72), math.ceil(pdf[i].get_height() * dpi / 72))
+                for i in range(npages)]
+    finally:
+        pdf.close()
+
+
+def cache_pages(pages, cache_dir, page_dir):
+    """
+    Moves rendered page files into page_dir under zero-padded, sortable names.
+    Returns the sorted list of cached page paths.
+    """
+    tmp_page_dir = cache_dir / f".{page_dir.name}.{os.getpid()}"
+    tmp_page_dir.mkdir()
+    for i, p in enumerate(pages, start=1):
+        shutil.move(str(p), str(tmp_page_dir / f"page-{i:04d}{Path(p).suffix}"))
+    try:
+        os.replace(tmp_page_dir, page_dir)
+    except OSError:
+        # another worker cached the same pages first
+        shutil.rmtree(tmp_page_dir)
+    return sorted(page_dir.glob("page-*"))
+
+
+def fit_page_size(size, max_height):
+    """
+    Returns the (width, height) a page of `size` pixels is scaled down to, so that its height <= max_height.
+    """
+    w, h = size
+    if h <= max_height:
+        return w, h
+    scale = max_height / float(h)
+    return int(w * scale), int(h * scale)
+
+
+def composed_size(page_sizes, max_pages=10, max_height=1200, gap=10):
+    """
+    Returns the (width, height) of the image compose_side_by_side() composes (with the same arguments)
+    from pages of the given pixel sizes, or None if there are no pages.
+    """
+    sizes = [fit_page_size(size, max_height) for size in page_sizes[:max_pages]]
+    if not sizes:
+        return None
+    return sum(w for w, _ in sizes) + gap * (len(sizes) - 1), max(h for _, h in sizes)
+
+
+def _prepare_page(im, max_height, plans):
+    """
+    Open (if given a path), convert to RGB and downscale a page so that its height <= max_height.
+    Too tall JPEG pages are decoded by libjpeg at a reduced scale (1/2, 1/4 or 1/8, never below
+    the target size) first, so the Lanczos resize only does the remaining fractional step.
+    Returns the page as an (h, w, 3) uint8 array.
+    """
+    if isinstance(im, (str, Path)):
+        im = Image.open(im)
+    # the target size follows from the full page size, also when decoding a JPEG at a reduced scale
+    size = fit_page_size(im.size, max_height)
+    if im.format == "JPEG" and size != im.size:
+        im.draft("RGB", size)
+    # rendered pages are opaque, so there is no need for an alpha channel
+    im = im.convert("RGB")
+    if im.size != size:
+        im = resize_lanczos(im, size, plans)
+    return np.asarray(im)
 
 
 def compose_side_by_side(images, max_pages=10, max_height=1200, gap=10):
@@ -142,49 +351,440 @@ def compose_side_by_side(images, max_pages=10, max_height=1200, gap=10):
     - gap: pixels between pages
     Returns a PIL.Image.
     """
-    imgs = []
-    for im in images[:max_pages]:
-        if isinstance(im, (str, Path)):
-            im = Image.open(im)
-        imgs.append(im.convert("RGBA"))
-
-    if not imgs:
+    images = list(images[:max_pages])
+    if not images:
         raise ValueError("No images to compose.")
 
-    # scale each so that height <= max_height (maintain relative heights)
-    scaled = []
-    for im in imgs:
-        w, h = im.size
-        if h > max_height:
-            scale = max_height / float(h)
-            new_w = int(w * scale)
-            new_h = int(h * scale)
-            im = im.resize((new_w, new_h), Image.LANCZOS)
-        scaled.append(im)
-
-    total_w = sum(im.width for im in scaled) + gap * (len(scaled) - 1)
-    max_h = max(im.height for im in scaled)
-
-    composed = Image.new("RGBA", (total_w, max_h), (255, 255, 255, 255))
+    # decode/convert/resize pages concurrently; Pillow (and pic-scale) release the GIL for these
+    plans = {}  # pages of one PDF usually share a size, so the resize plan is reused
+    with ThreadPoolExecutor(max_workers=min(4, len(images))) as executor:
+        arrays = list(executor.map(lambda im: _prepare_page(im, max_height, plans), images))
+
+    total_w = sum(a.shape[1] for a in arrays) + gap * (len(arrays) - 1)
+    max_h = max(a.shape[0] for a in arrays)
+
+    composed = np.full((max_h, total_w, 3), 255, dtype=np.uint8)
     x = 0
-    for im in scaled:
+    for a in arrays:
         # vertically align top (you may change to center)
-        composed.paste(im, (x, 0), im if im.mode == "RGBA" else None)
-        x += im.width + gap
+        h, w = a.shape[:2]
+        composed[:h, x:x + w] = a
+        x += w + gap
+
+    return Image.fromarray(composed)
 
-    return composed.convert("RGB")
+
+def frame_canvas_size(frames):
+    """
+    Returns the (width, height) that fits every frame image (list of paths).
+    Only the image headers are read.
+    """
+    width, height = 0, 0
+    for p in frames:
+        with Image.open(p) as im:
+            width, height = max(width, im.width), max(height, im.height)
+    return width, height
+
+
+def load_padded_frame(frame, size):
+    """
+    Loads a frame (image path or PIL.Image) as RGB, padded with white (top-left aligned) to `size`,
+    which must fit every frame: frames are never scaled, so all of them keep the same pixel size.
+    """
+    if isinstance(frame, (str, Path)):
+        with Image.open(frame) as im:
+            return load_padded_frame(im.convert("RGB"), size)
+    im = frame.convert("RGB")
+    if im.width > size[0] or im.height > size[1]:
+        logging.warning("Frame of %dx%d does not fit the %dx%d canvas and is cropped", *im.size, *size)
+    canvas = Image.new("RGB", size, (255, 255, 255))
+    canvas.paste(im, (0, 0))
+    return canvas
+
+
+def merge_duplicate_frames(results, frame_duration):
+    """
+    Merges consecutive identical frames into one longer frame.
+    - results: iterable of (frame, sha256 digest) per commit, or None for skipped commits.
+    Yields (frame, duration in seconds) lazily, holding on to at most one pending frame.
+    """
+    pending, pending_hash, duration = None, None, 0
+    ncommits, nframes = 0, 0
+    for result in results:
+        if result is None:
+            continue
+        ncommits += 1
+        frame, frame_hash = result
+        if pending is not None and frame_hash == pending_hash:
+            duration += frame_duration
+            continue
+        if pending is not None:
+            nframes += 1
+            yield pending, duration
+        pending, pending_hash, duration = frame, frame_hash, frame_duration
+    if pending is not None:
+        nframes += 1
+        yield pending, duration
+    logging.info("%d distinct frames from %d composed commits", nframes, ncommits)
+
+
+def frame_repeats(duration, frame_duration):
+    """
+    Number of times a frame shown for `duration` seconds is emitted in a stream running at
+    one frame per `frame_duration` seconds.
+    """
+    return max(1, round(duration / frame_duration))
+
+
+def encode_with_imageio(frames, frame_duration, output, size):
+    """
+    Fallback encoder: appends the frames to an imageio writer one at a time, so only the current
+    frame is decoded at any point.
+    - frames: iterable of (image path or PIL.Image, display time in seconds, a multiple of frame_duration).
+    - size: (width, height) every frame is padded to; for videos rounded up to a multiple of 16,
+      as imageio-ffmpeg would otherwise rescale the frames.
+    """
+    if Path(output).suffix.lower() in VIDEO_SUFFIXES:
+        options = {"fps": 1 / frame_duration}
+        size = (-(-size[0] // 16) * 16, -(-size[1] // 16) * 16)
+    else:
+        # Pillow-backed formats (e.g. APNG, WebP) take the frame duration in milliseconds
+        options = {"duration": frame_duration * 1000}
+    with imageio.get_writer(str(output), mode="I", **options) as writer:
+        for frame, duration in frames:
+            data = np.asarray(load_padded_frame(frame, size))
+            for _ in range(frame_repeats(duration, frame_duration)):
+                writer.append_data(data)
+
+
+def quantize_to_palette(im, palette):
+    """
+    Maps an RGB PIL.Image to the nearest colors of `palette` ((n, 3) uint8 array, n <= 256).
+    Returns a P-mode PIL.Image using that palette. Pillow's own palette conversion looks colors up
+    in a reduced-precision cache, which e.g. turns the white page background slightly grey.
+    """
+    arr = np.asarray(im, dtype=np.uint32)
+    packed = (arr[..., 0] << 16) | (arr[..., 1] << 8) | arr[..., 2]
+    # typeset pages have few distinct colors, so match those rather than every pixel
+    colors, inverse = np.unique(packed.ravel(), return_inverse=True)
+    rgb = np.stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255], axis=1).astype(np.int32)
+    pal = palette.astype(np.int32)
+    nearest = np.empty(len(colors), dtype=np.uint8)
+    for start in range(0, len(rgb), 4096):
+        dist = ((rgb[start:start + 4096, None, :] - pal[None, :, :]) ** 2).sum(axis=2)
+        nearest[start:start + 4096] = dist.argmin(axis=1)
+    out = Image.fromarray(nearest[inverse].reshape(packed.shape))
+    out.putpalette(palette.ravel().tolist())
+    return out
+
+
+def encode_gif_global_palette(frames, output, size, sample_every=4):
+    """
+    Fallback GIF encoder: quantizes every frame against one palette computed from a sample of
+    the frames, so the GIF has a single global color table and no local ones. Frames are written
+    to the file one at a time (with disposal=2).
+    - frames: list of (image path or PIL.Image, display time in seconds); iterated twice.
+    - size: (width, height) every frame is padded to.
+    - sample_every: every n-th frame (and every n-th pixel row/column of it) is used for the palette.
+    """
+    sample = []
+    for frame, _ in frames[::sample_every]:
+        pixels = np.asarray(load_padded_frame(frame, size))[::sample_every, ::sample_every]
+        sample.append(pixels.reshape(-1, 1, 3))
+    quantized = Image.fromarray(np.concatenate(sample)).quantize(colors=256, method=Image.MEDIANCUT)
+    palette = np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3)[:256]
+
+    with open(output, "wb") as fp:
+        for i, (frame, duration) in enumerate(frames):
+            im = quantize_to_palette(load_padded_frame(frame, size), palette)
+            if i == 0:
+                header, _ = GifImagePlugin.getheader(im, info={"loop": 0})
+                fp.writelines(header)
+            fp.writelines(GifImagePlugin.getdata(im, duration=int(duration * 1000), disposal=2))
+        fp.write(b";")  # GIF trailer
+
+
+def encode_with_ffmpeg(ffmpeg, frames, frame_duration, output, size):
+    """
+    Encode the frames into `output` with ffmpeg.
+    - frames: iterable of (image path or PIL.Image, display time in seconds, a multiple of frame_duration);
+      the stream runs at one frame per frame_duration, so longer frames are written repeatedly.
+    - size: (width, height) every frame is padded to (rounded up to even numbers).
+    GIFs get a two-pass palettegen/paletteuse filter, .webm files VP9 and anything else H.264 (yuv420p).
+    Frames are piped to ffmpeg one at a time as raw RGB: ffmpeg resets its filter graph (and so
+    palettegen) whenever the input size changes, so the stream must have a constant frame size.
+    """
+    output = Path(output)
+    width, height = size
+    # yuv420p needs even dimensions
+    width += width % 2
+    height += height % 2
+
+    fps = Fraction(1 / frame_duration).limit_denominator(1000)
+    cmd = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+           "-s", f"{width}x{height}", "-framerate", str(fps), "-i", "-"]
+    suffix = output.suffix.lower()
+    if suffix == ".gif":
+        cmd += ["-vf", "split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse", "-loop", "0"]
+    elif suffix == ".webm":
+        cmd += ["-c:v", "libvpx-vp9", "-pix_fmt", "yuv420p"]
+    else:
+        cmd += ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+    cmd.append(str(output))
+
+    logging.debug("RUN: %s", " ".join(cmd))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for frame, duration in frames:
+            data = load_padded_frame(frame, (width, height)).tobytes()
+            for _ in range(frame_repeats(duration, frame_duration)):
+                proc.stdin.write(data)
+    finally:
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {proc.returncode}")
+
+
+def encode_with_gifski(gifski, frames, frame_duration, output, size, quality=90):
+    """
+    Encode a GIF with gifski (libimagequant palettes, computed in parallel), which gives smaller
+    files of better quality than ffmpeg's palettegen or Pillow.
+    - frames: list of (composed PNG path, display time in seconds, a multiple of frame_duration);
+      gifski runs at one frame per frame_duration, so longer frames are passed repeatedly.
+    - size: (width, height) every frame is padded to; gifski needs frames of one size, so padded
+      copies are written (to a temporary dir) only for frames of a different size.
+    """
+    with tempfile.TemporaryDirectory(prefix="gifski_") as tmpdir:
+        paths = []
+        for i, (frame, duration) in enumerate(frames):
+            with Image.open(frame) as im:
+                if im.size != tuple(size):
+                    frame = Path(tmpdir) / f"frame_{i:04d}.png"
+                    load_padded_frame(im, size).save(frame, format="PNG")
+            paths += [str(frame)] * frame_repeats(duration, frame_duration)
+        # without an explicit size gifski shrinks the animation to about 800x600, making the text unreadable
+        cmd = [gifski, "--quiet", "-o", str(output), "--fps", str(1 / frame_duration),
+               "--quality", str(quality), "--width", str(size[0]), "--height", str(size[1])]
+        run(cmd + paths)
+
+
+def get_source_keys(git, repo_path, commits, tex_file):
+    """
+    Returns, for each commit, a key hashing the tex path and the git tree of the directory containing
+    it (None if that directory does not exist in that commit). Two commits with the same key build the
+    same document (as long as it only reads files below that directory), so the key is used to address
+    the PDF/page cache; the tex path keeps different documents of one directory apart.
+    All commits are resolved by a single `git cat-file --batch-check` process (git is the path to
+    the executable).
+    """
+    tex_dir = Path(tex_file).parent.as_posix()
+    specs = [f"{commit}:" if tex_dir == "." else f"{commit}:{tex_dir}" for commit in commits]
+    proc = run([git, "-C", str(repo_path), "cat-file", "--batch-check"], capture_output=True,
+               input="".join(spec + "\n" for spec in specs))
+    keys = []
+    # one output line per input line: "<sha> <type> <size>", or "<spec> missing"
+    for line in proc.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == "tree":
+            keys.append(hashlib.sha256(f"{fields[0]}:{Path(tex_file).as_posix()}".encode()).hexdigest())
+        else:
+            keys.append(None)
+    if len(keys) != len(commits):
+        raise RuntimeError(f"git cat-file returned {len(keys)} lines for {len(commits)} commits")
+    return keys
+
+
+def store_in_cache(src, dst):
+    """
+    Copy src to dst atomically, so concurrent workers never see a half-written cache entry.
+    """
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}")
+    shutil.copy(src, tmp)
+    os.replace(tmp, dst)
+
+
+def export_commit(git, repo_path, commit, dest):
+    """
+    Extract the tree of `commit` into dest using `git archive` (git is the path to the executable),
+    without touching the index or the checkout of the repository.
+    """
+    proc = subprocess.Popen([git, "-C", str(repo_path), "archive", "--format=tar", commit],
+                            stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(dest, filter="data")
+            else:
+                tar.extractall(dest)
+    finally:
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"git archive failed for commit {commit} (exit code {proc.returncode})")
+
+
+def build_commit_pdf(repo_path, commit, tex_rel, workdir, tools):
+    """
+    Export `commit` into a source directory below workdir and build the tex file there.
+    Returns the path to the resulting PDF (inside workdir) or raises on failure.
+    """
+    srcdir = workdir / "src"
+    build_outdir = workdir / "out"
+    srcdir.mkdir(parents=True, exist_ok=True)
+    build_outdir.mkdir(parents=True, exist_ok=True)
+    export_commit(tools["git"], repo_path, commit, srcdir)
+    # Some builds rely on relative file paths; running in the source root is safest.
+    return build_latex(srcdir, tex_rel, srcdir, build_outdir, tools)
+
+
+def clean_workdir(workdir):
+    """
+    Empty a reused scratch dir, so nothing of the previous commit can leak into the next build:
+    `git archive` only adds files, so sources deleted since (and the aux files of \\include'd
+    chapters) would otherwise stay around. TeX keeps its format and font caches in TEXMFVAR,
+    not in the build dir, so nothing worth reusing is lost.
+    """
+    for p in workdir.iterdir():
+        if p.is_dir() and not p.is_symlink():
+            shutil.rmtree(p)
+        else:
+            p.unlink()
+
+
+def process_commit(idx, total, commit, key, repo_path, tex_rel, outdir, scratch_root, tools, args,
+                   save_png=True, size_only=False):
+    """
+    Build and render a single commit in a scratch dir below scratch_root.
+    Each worker process reuses one scratch dir for all its commits (emptied before each of them),
+    which saves creating a temporary directory per commit.
+    PDFs and pdftoppm-rendered pages are cached in outdir/.pdf_cache under `key` (see get_source_keys()),
+    so re-runs and commits that do not change the document skip the LaTeX build.
+    Returns (composed frame, sha256 digest of its pixels), or None if the commit had to be skipped.
+    The frame is the path of the composed PNG written to outdir, or the PIL.Image itself if not save_png.
+    With size_only, only the (width, height) of the composed frame is returned (or None), computed from
+    the page sizes: the PDF is built (and cached) as usual, but no page is rendered by pypdfium2 or composed.
+    tools is the dict returned by find_tools().
+    Runs in a worker process, so it must not touch the checkout of the original repository.
+    """
+    short = commit[:8]
+    logging.info("[%d/%d] Processing commit %s", idx, total, short)
+
+    cache_dir = outdir / ".pdf_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cached_pdf = cache_dir / f"{key}.pdf"
+    page_dir = cache_dir / f"{key}_{args.dpi}dpi_{args.max_pages}p"
+
+    workdir = Path(scratch_root) / f"worker_{os.getpid()}"
+    workdir.mkdir(parents=True, exist_ok=True)
+    clean_workdir(workdir)
+    # in-process rendering is cheap enough that only pdftoppm output is cached
+    pages = sorted(page_dir.glob("page-*")) if pdfium is None else []
+    if pages:
+        logging.info("Using cached pages for commit %s", short)
+    else:
+        if cached_pdf.exists():
+            logging.info("Using cached PDF for commit %s", short)
+            pdf_path = cached_pdf
+        else:
+            try:
+                pdf_path = build_commit_pdf(repo_path, commit, tex_rel, workdir, tools)
+            except Exception as e:
+                logging.warning("Build failed for commit %s : %s", short, e)
+                # skip this commit but continue
+                return None
+            store_in_cache(pdf_path, cached_pdf)
+
+        if pdfium is not None:
+            try:
+                if size_only:
+                    page_sizes = pdf_page_sizes(pdf_path, dpi=args.dpi, max_pages=args.max_pages,
+                                                max_height=MAX_PAGE_HEIGHT)
+                    return composed_size(page_sizes, max_pages=args.max_pages, max_height=MAX_PAGE_HEIGHT,
+                                         gap=PAGE_GAP)
+                pages = render_pdf_pages(pdf_path, dpi=args.dpi, max_pages=args.max_pages,
+                                         max_height=MAX_PAGE_HEIGHT)
+            except Exception as e:
+                logging.warning("Rendering failed for commit %s: %s", short, e)
+                return None
+        else:
+            # convert to jpeg pages using pdftoppm
+            png_prefix = workdir / "page"
+            try:
+                pages = pdf_to_png_pages(pdf_path, png_prefix, tools, dpi=args.dpi, max_pages=args.max_pages,
+                                         max_height=MAX_PAGE_HEIGHT)
+            except Exception as e:
+                logging.warning("pdftoppm failed for commit %s: %s", short, e)
+                return None
+            if pages:
+                pages = cache_pages(pages, cache_dir, page_dir)
+
+        if not pages:
+            logging.warning("No pages produced for commit %s", short)
+            return None
+
+    if size_only:
+        # pdftoppm pages: only their headers are read
+        page_sizes = []
+        for p in pages:
+            with Image.open(p) as im:
+                page_sizes.append(im.size)
+        return composed_size(page_sizes, max_pages=args.max_pages, max_height=MAX_PAGE_HEIGHT, gap=PAGE_GAP)
+
+    # compose side-by-side
+    try:
+        composed_img = compose_side_by_side(pages, max_pages=args.max_pages,
+                                            max_height=MAX_PAGE_HEIGHT, gap=PAGE_GAP)
+    except Exception as e:
+        logging.warning("Failed to compose PNG for commit %s: %s", short, e)
+        return None
+
+    frame_hash = hashlib.sha256(composed_img.tobytes()).digest()
+    if not save_png:
+        return composed_img, frame_hash
+    out_png = outdir / f"composed_{idx:04d}_{short}.png"
+    composed_img.save(out_png, format="PNG")
+    logging.info("Wrote %s", out_png)
+    return out_png, frame_hash
+
+
+def iter_commit_results(commit_keys, submit, window):
+    """
+    Yields the result of every commit (oldest -> newest); None keys are skipped.
+    - submit: callable starting the processing of a source key, returning its future.
+    - window: number of distinct keys submitted ahead of the one being yielded, so finished frames
+      waiting for a slower consumer (e.g. the encoder) do not pile up in memory.
+    A future is dropped once the last commit using it has been yielded.
+    """
+    remaining = Counter(key for key in commit_keys if key is not None)
+    order = list(remaining)  # distinct keys, in the order of their first commit
+    futures = {}
+    seen = set()
+    nsubmitted = 0
+    for key in commit_keys:
+        if key is None:
+            continue
+        seen.add(key)
+        # the current key (order[len(seen) - 1]) and `window` keys after it are submitted
+        while nsubmitted < min(len(order), len(seen) + window):
+            futures[order[nsubmitted]] = submit(order[nsubmitted])
+            nsubmitted += 1
+        yield futures[key].result()
+        remaining[key] -= 1
+        if not remaining[key]:
+            del futures[key]
 
 
 def main():
     parser = argparse.ArgumentParser(description="Create animation of LaTeX document across git history commits.")
     parser.add_argument("repo", help="Path to the git repository")
     parser.add_argument("--tex", default="main.tex", help="Main .tex file path relative to repo root (default: main.tex)")
-    parser.add_argument("--out", default="history_anim.gif", help="Output animation filename (gif recommended)")
-    parser.add_argument("--out-dir", default="latex_history_out", help="Directory to store intermediate PNGs and PDFs")
+    parser.add_argument("--out", default="history_anim.gif", help="Output animation filename (.gif, or .mp4/.webm with ffmpeg)")
+    parser.add_argument("--out-dir", default="latex_history_out", help="Directory to store cached PDFs and intermediate PNGs")
     parser.add_argument("--max-pages", type=int, default=10, help="Max pages to show side-by-side (default 10)")
-    parser.add_argument("--dpi", type=int, default=150, help="DPI for pdftoppm rendering (default 150)")
+    parser.add_argument("--dpi", type=int, default=150, help="Maximum DPI for page rendering (default 150); lowered so pages are at most 1200px tall")
     parser.add_argument("--frame-duration", type=float, default=1.0, help="Frame duration (seconds) for GIF (default 1.0)")
-    parser.add_argument("--keep-temp", action="store_true", help="Keep temporary build directories")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of commits to build in parallel (default: number of CPUs)")
+    parser.add_argument("--keep-temp", action="store_true", help="Keep the scratch build directories and the composed PNGs in --out-dir")
     parser.add_argument("--verbose", action="store_true")
     args = parser.parse_args()
 
@@ -196,7 +796,8 @@ def main():
         logging.error("Repo path does not exist: %s", repo_path)
         sys.exit(2)
 
-    ensure_tools_exist()
+    tools = find_tools()
+    ensure_tools_exist(tools)
 
     tex_rel = Path(args.tex)
     tex_abs = repo_path / tex_rel
@@ -204,19 +805,7 @@ def main():
         logging.error("Specified tex file not found in repo: %s", tex_abs)
         sys.exit(2)
 
-    orig_cwd = Path.cwd()
-    # remember current branch/commit to restore later
-    logging.info("Recording current git HEAD to restore later.")
-    try:
-        res = run(["git", "-C", str(repo_path), "rev-parse", "--abbrev-ref", "HEAD"], capture_output=True)
-        original_branch = res.stdout.strip()
-    except Exception:
-        # detached? get hash
-        res = run(["git", "-C", str(repo_path), "rev-parse", "HEAD"], capture_output=True)
-        original_branch = res.stdout.strip()
-    logging.info("Original HEAD: %s", original_branch)
-
-    commits = get_commits_touching_file(repo_path, tex_rel)
+    commits = get_commits_touching_file(tools["git"], repo_path, tex_rel)
     if not commits:
         logging.error("No commits found touching the file %s", tex_rel)
         sys.exit(2)
@@ -224,88 +813,87 @@ def main():
     outdir = Path(args.out_dir).resolve()
     outdir.mkdir(parents=True, exist_ok=True)
 
-    composed_pngs = []
-
-    for idx, commit in enumerate(commits, start=1):
-        short = commit[:8]
-        logging.info("[%d/%d] Processing commit %s", idx, len(commits), short)
-        try:
-            # checkout commit (detached)
-            run(["git", "-C", str(repo_path), "checkout", "--quiet", commit])
-
-            # We'll build in a temporary working directory inside the repo to avoid messing up repo files
-            with tempfile.TemporaryDirectory(prefix="latex_build_", dir=str(repo_path)) as workdir:
-                # copy the tex file and any local includes? Simpler: run build in repo root, but specify output dir inside temp.
-                # Some builds rely on relative file paths; running in repo root is safest.
-                build_outdir = Path(workdir) / "out"
-                build_outdir.mkdir(parents=True, exist_ok=True)
-                try:
-                    pdf_path = build_latex(repo_path, tex_rel, repo_path, build_outdir)
-                except Exception as e:
-                    logging.warning("Build failed for commit %s : %s", short, e)
-                    # skip this commit but continue
-                    continue
-
-                # convert to png pages using pdftoppm
-                png_prefix = Path(workdir) / "page"
-                try:
-                    pages = pdf_to_png_pages(pdf_path, png_prefix, dpi=args.dpi, max_pages=args.max_pages)
-                except Exception as e:
-                    logging.warning("pdftoppm failed for commit %s: %s", short, e)
-                    continue
-
-                if not pages:
-                    logging.warning("No pages produced for commit %s", short)
-                    continue
-
-                # compose side-by-side
-                try:
-                    composed_img = compose_side_by_side(pages, max_pages=args.max_pages, max_height=1200, gap=8)
-                except Exception as e:
-                    logging.warning("Failed to compose PNG for commit %s: %s", short, e)
-                    continue
-
-                out_png = outdir / f"composed_{idx:04d}_{short}.png"
-                composed_img.save(out_png, format="PNG")
-                logging.info("Wrote %s", out_png)
-                composed_pngs.append(out_png)
-
-            # optionally, small safety sleep? Not necessary.
-
-        finally:
-            # after processing each commit, do not restore original branch yet — do that at the end.
-            pass
-
-    # restore original HEAD
-    try:
-        run(["git", "-C", str(repo_path), "checkout", "--quiet", original_branch])
-        logging.info("Restored original HEAD: %s", original_branch)
-    except Exception as e:
-        logging.warning("Could not restore original HEAD (%s): %s. You may need to checkout manually.", original_branch, e)
-
-    if not composed_pngs:
-        logging.error("No composed PNGs were generated. Exiting.")
+    ffmpeg = tools["ffmpeg"]
+    output_anim = Path(args.out)
+    # gifski only reads image files, so it needs the composed PNGs
+    gifski = tools["gifski"] if output_anim.suffix.lower() == ".gif" else None
+    # Unless temporary files are kept, composed frames are handed to ffmpeg in memory instead of as PNGs
+    stream_frames = ffmpeg is not None and gifski is None and not args.keep_temp
+
+    # Commits with the same sources (e.g. a change that was reverted later) build the same document:
+    # each distinct source tree is processed once, and its frame is reused for every commit having it.
+    commit_keys = get_source_keys(tools["git"], repo_path, commits, tex_rel)
+    for commit, key in zip(commits, commit_keys):
+        if key is None:
+            # e.g. the commit deleted the directory holding the tex file
+            logging.warning("Could not resolve sources for commit %s", commit[:8])
+    first_commit = {}  # key -> index of the first commit with those sources
+    for i, key in enumerate(commit_keys):
+        if key is not None:
+            first_commit.setdefault(key, i)
+    if not first_commit:
+        logging.error("Could not resolve the sources of any commit. Exiting.")
         sys.exit(2)
 
-    # Build GIF animation
-    logging.info("Building animation %s", args.out)
-    frames = []
-    for p in composed_pngs:
-        img = imageio.imread(str(p))
-        frames.append(img)
-
-    # save gif
-    output_anim = Path(args.out)
+    # Each commit is built from its own export, so commits can be processed concurrently
+    # without ever touching the checkout of the original repository.
+    jobs = max(1, min(args.jobs or os.cpu_count() or 1, len(first_commit)))
+    logging.info("Processing %d commits with distinct sources (of %d) with %d parallel jobs",
+                 len(first_commit), len(commits), jobs)
+    scratch_root = Path(tempfile.mkdtemp(prefix="latex_build_"))
     try:
-        imageio.mimsave(str(output_anim), frames, duration=args.frame_duration)
-        logging.info("Animation saved to %s", output_anim)
-    except Exception as e:
-        logging.error("Failed to write animation: %s", e)
-        sys.exit(1)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            def submit(key, **kwargs):
+                i = first_commit[key]
+                return executor.submit(process_commit, i + 1, len(commits), commits[i], key, repo_path, tex_rel,
+                                       outdir, scratch_root, tools, args, **kwargs)
+
+            # at most 2 * jobs distinct commits are processed ahead of the one being encoded
+            window = 2 * jobs
+            if stream_frames:
+                # The stream needs a constant frame size that fits every frame before the first one is
+                # written: a first pass builds every commit (filling the PDF cache) and computes its frame
+                # size from the page sizes alone; the frames are rendered and composed while encoding.
+                sizes = {key: submit(key, size_only=True) for key in first_commit}
+                sizes = {key: f.result() for key, f in sizes.items()}
+                fitting = [s for s in sizes.values() if s is not None]
+                size = (max(w for w, _ in fitting), max(h for _, h in fitting)) if fitting else None
+                # commits that failed in the first pass are skipped
+                keys = [key if key is not None and sizes[key] is not None else None for key in commit_keys]
+                results = iter_commit_results(keys, lambda key: submit(key, save_png=False), window)
+                # collect in commit order so frames stay oldest -> newest
+                frames = merge_duplicate_frames(results, args.frame_duration)
+            else:
+                results = iter_commit_results(commit_keys, submit, window)
+                frames = list(merge_duplicate_frames(results, args.frame_duration))
+                size = frame_canvas_size(p for p, _ in frames) if frames else None
+
+            if size is None:
+                logging.error("No frames were composed. Exiting.")
+                sys.exit(2)
+
+            # Build animation: gifski (GIF) or ffmpeg if available, Pillow (GIF) or imageio otherwise
+            logging.info("Building animation %s", output_anim)
+            try:
+                if gifski:
+                    encode_with_gifski(gifski, frames, args.frame_duration, output_anim, size)
+                elif ffmpeg:
+                    encode_with_ffmpeg(ffmpeg, frames, args.frame_duration, output_anim, size)
+                elif output_anim.suffix.lower() == ".gif":
+                    encode_gif_global_palette(frames, output_anim, size)
+                else:
+                    encode_with_imageio(frames, args.frame_duration, output_anim, size)
+                logging.info("Animation saved to %s", output_anim)
+            except Exception as e:
+                logging.error("Failed to write animation: %s", getattr(e, "stderr", None) or e)
+                sys.exit(1)
+    finally:
+        if args.keep_temp:
+            logging.info("Kept scratch build directories in %s", scratch_root)
+        else:
+            shutil.rmtree(scratch_root, ignore_errors=True)
 
     logging.info("Done. Intermediate files are in %s", outdir)
-    if args.keep_temp:
-        logging.info("Note: script was asked to keep temporary build dirs, but this script uses ephemeral temps inside the repo; see %s for composed images.", outdir)
 
 
 if __name__ == "__main__":